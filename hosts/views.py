@@ -1,5 +1,6 @@
 import json
 import logging
+import zlib
 
 from django import http
 from django.conf import settings
@@ -152,12 +153,45 @@ def kernel_detail(request, slug):
 @public
 def update(request, name):
     """Update a host and all it's related information from a JSON."""
+    # Verify the client before decoding the payload, it requires only the hostname from the URL
+    if settings.DEBMONITOR_VERIFY_CLIENTS:
+        ssl_verify = request.META.get(SSL_CLIENT_VERIFY_HEADER, '')
+        if ssl_verify != SSL_CLIENT_VERIFY_SUCCESS:
+            return http.HttpResponseForbidden('Client certificate validation failed: {message}'.format(
+                message=ssl_verify))
+
+        ssl_dn = request.META.get(SSL_CLIENT_SUBJECT_DN_HEADER, '')
+        if not is_valid_cn(ssl_dn, name):
+            return http.HttpResponseForbidden("Unauthorized to update host '{name}' with certificate '{dn}'".format(
+                name=name, dn=ssl_dn))
+
     if not request.body:
         return http.HttpResponseBadRequest("Empty POST, expected JSON string: {req}".format(
             req=request))
 
+    body = request.body
+    content_encoding = request.META.get('HTTP_CONTENT_ENCODING', 'identity')
+    if content_encoding == 'gzip':
+        # Limit the decompressed size like Django does for the request body, to protect from decompression bombs
+        max_size = settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 0  # None disables the check, as 0 does for zlib
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # Expect the gzip header and trailer
+        try:
+            body = decompressor.decompress(body, max_size)
+        except zlib.error as e:
+            return http.HttpResponseBadRequest('Unable to decompress gzip payload: {e}'.format(e=e))
+
+        if not decompressor.eof:  # Either stopped at the limit or the input is truncated
+            if max_size and len(body) >= max_size:
+                return http.HttpResponse('Decompressed gzip payload exceeds {size} bytes'.format(size=max_size),
+                                         status=413)
+
+            return http.HttpResponseBadRequest('Unable to decompress gzip payload: truncated input')
+    elif content_encoding != 'identity':
+        return http.HttpResponseBadRequest("Unsupported Content-Encoding '{enc}', expected gzip or identity".format(
+            enc=content_encoding))
+
     try:
-        payload = json.loads(request.body.decode('utf-8'))
+        payload = json.loads(body.decode('utf-8'))
     except JSONDecodeError as e:
         return http.HttpResponseBadRequest('Unable to parse JSON string payload: {e}'.format(e=e))
 
@@ -165,17 +199,6 @@ def update(request, name):
         return http.HttpResponseBadRequest("URL host '{name}' and POST payload hostname '{host}' do not match".format(
             name=name, host=payload.get('hostname', '')))
 
-    if settings.DEBMONITOR_VERIFY_CLIENTS:
-        ssl_verify = request.META.get(SSL_CLIENT_VERIFY_HEADER, '')
-        if ssl_verify != SSL_CLIENT_VERIFY_SUCCESS:
-            return http.HttpResponseForbidden('Client certificate validation failed: {message}'.format(
-                message=ssl_verify))
-
-        ssl_dn = request.META.get(SSL_CLIENT_SUBJECT_DN_HEADER, '')
-        if not is_valid_cn(ssl_dn, name):
-            return http.HttpResponseForbidden("Unauthorized to update host '{name}' with certificate '{dn}'".format(
-                name=name, dn=ssl_dn))
-
     try:
         os = OS.objects.get(name=payload['os'])
     except OS.DoesNotExist as e:
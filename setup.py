@@ -25,6 +25,7 @@ extras_require = {
         'pytest>=3.5.0',
         'pytest-cov>=2.5.1',
         'pytest-django>=3.1.2',
+        'pytest-xdist>=1.22.0; python_version >= "3.6"',
         'requests-mock>=1.3.0',
     ],
 }
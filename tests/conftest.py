@@ -1,3 +1,7 @@
+import sys
+
+from unittest.mock import MagicMock, patch
+
 import pytest
 import requests_mock
 
@@ -12,6 +16,17 @@ def django_db_setup(django_db_setup, django_db_blocker):
 
 @pytest.fixture()
 def mocked_requests():
-    """Set mocked requests fixture."""
+    """Set mocked requests fixture, not autouse: request it only in the tests that perform HTTP requests."""
     with requests_mock.Mocker() as mocker:
         yield mocker
+
+
+@pytest.fixture(scope='session')
+def cli_module():
+    """Import once the DebMonitor CLI module with the Debian-only dependencies mocked."""
+    mocked_apt = MagicMock()
+    mocked_apt.cache.Filter = object
+    with patch.dict(sys.modules, {'apt': mocked_apt}):
+        from utils import cli
+
+    return cli
@@ -1,4 +1,4 @@
-from unittest.mock import patch, mock_open
+import io
 
 import pytest
 
@@ -23,6 +23,14 @@ CLIENT_BODY_NO_VERSION = 'import os'
 CLIENT_CHECKSUM_NO_VERSION = 'ed9f4b8f879ddbb59fda1057ea3a2810'
 
 
+@pytest.fixture()
+def fake_client_file(request, monkeypatch):
+    """Make open() return an in-memory file with the client body passed as indirect parameter."""
+    body = request.param
+    monkeypatch.setattr('builtins.open', lambda *args, **kwargs: io.StringIO(body))
+    return body
+
+
 def test_index_reverse_url():
     """Reversing the homepage URL name should return the correct URL."""
     url = reverse('index')
@@ -48,40 +56,19 @@ def test_client_reverse_url():
     assert url == CLIENT_URL
 
 
-@pytest.mark.django_db
-@patch('builtins.open', mock_open(read_data=CLIENT_BODY_NO_VERSION))
-def test_client_get_no_version(client):
-    """A GET to the client endpoint should return the client with its version and checksum."""
-    response = client.get(CLIENT_URL)
-
-    assert response.status_code == 200
-    assert response[views.CLIENT_VERSION_HEADER] == ''
-    assert response[views.CLIENT_CHECKSUM_HEADER] == CLIENT_CHECKSUM_NO_VERSION
-    assert response.content.decode('utf-8') == CLIENT_BODY_NO_VERSION
-
-
-@pytest.mark.django_db
-@patch('builtins.open', mock_open(read_data=CLIENT_BODY_DUMMY_1))
-def test_client_get(client, settings):
-    """A GET to the client endpoint should return the client with its version and checksum."""
-    response = client.get(CLIENT_URL)
-
-    assert response.status_code == 200
-    assert response[views.CLIENT_VERSION_HEADER] == CLIENT_VERSION
-    assert response[views.CLIENT_CHECKSUM_HEADER] == CLIENT_CHECKSUM_DUMMY_1
-    assert response.content.decode('utf-8') == CLIENT_BODY_DUMMY_1
-
-
-@pytest.mark.django_db
-@patch('builtins.open', mock_open(read_data=CLIENT_BODY_DUMMY_2))
-def test_client_head(client, settings):
-    """A HEAD to the client endpoint should return the client's version and checksum."""
-    response = client.head(CLIENT_URL)
+@pytest.mark.parametrize('fake_client_file, method, version, checksum, content', (
+    (CLIENT_BODY_NO_VERSION, 'get', '', CLIENT_CHECKSUM_NO_VERSION, CLIENT_BODY_NO_VERSION),
+    (CLIENT_BODY_DUMMY_1, 'get', CLIENT_VERSION, CLIENT_CHECKSUM_DUMMY_1, CLIENT_BODY_DUMMY_1),
+    (CLIENT_BODY_DUMMY_2, 'head', CLIENT_VERSION, CLIENT_CHECKSUM_DUMMY_2, ''),
+), indirect=['fake_client_file'])
+def test_client(client, fake_client_file, method, version, checksum, content):
+    """A GET/HEAD to the client endpoint should return the client (GET only) with its version and checksum."""
+    response = getattr(client, method)(CLIENT_URL)
 
     assert response.status_code == 200
-    assert response[views.CLIENT_VERSION_HEADER] == CLIENT_VERSION
-    assert response[views.CLIENT_CHECKSUM_HEADER] == CLIENT_CHECKSUM_DUMMY_2
-    assert response.content.decode('utf-8') == ''
+    assert response[views.CLIENT_VERSION_HEADER] == version
+    assert response[views.CLIENT_CHECKSUM_HEADER] == checksum
+    assert response.content.decode('utf-8') == content
 
 
 def test_client_view_function():
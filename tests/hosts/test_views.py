@@ -1,3 +1,4 @@
+import gzip
 import uuid
 
 import pytest
@@ -151,6 +152,32 @@ def test_update_status_code_invalid_payload(client):
     assert response.status_code == 400
 
 
+@pytest.mark.parametrize('encoding, body', (
+    ('gzip', b'invalid_gzip'),
+    ('gzip', gzip.compress(b'{"hostname": "host1.example.com"')[:-10]),
+    ('br', b'{"hostname": "host1.example.com"}'),
+))
+def test_update_status_code_invalid_encoding(client, encoding, body):
+    """Trying to update an host with a payload that can't be decoded should return 400 Bad Request."""
+    response = client.generic('POST', EXISTING_HOST_UPDATE_URL, body, HTTP_CONTENT_ENCODING=encoding)
+    assert response.status_code == 400
+
+
+def test_update_status_code_gzip_too_big(client, settings):
+    """Trying to update an host with a gzip payload that decompresses over the limit should return 413."""
+    settings.DATA_UPLOAD_MAX_MEMORY_SIZE = 1024
+    body = gzip.compress(b' ' * (settings.DATA_UPLOAD_MAX_MEMORY_SIZE + 1))
+    response = client.generic('POST', EXISTING_HOST_UPDATE_URL, body, HTTP_CONTENT_ENCODING='gzip')
+    assert response.status_code == 413
+
+
+def test_update_status_code_gzip_missing_cert(client, settings):
+    """Trying to update an host with a gzip payload and a missing certificate should return 403 before decoding it."""
+    settings.DEBMONITOR_VERIFY_CLIENTS = True
+    response = client.generic('POST', EXISTING_HOST_UPDATE_URL, b'invalid_gzip', HTTP_CONTENT_ENCODING='gzip')
+    assert response.status_code == 403
+
+
 def test_update_status_code_wrong_hostname(client):
     """Trying to update an host with a payload for a different hostname should return 400 Bad Request."""
     response = client.generic('POST', EXISTING_HOST_UPDATE_URL, '{"hostname": "non_existing_host.example.com"}')
@@ -230,6 +257,14 @@ def test_update_status_code_existing_no_update(client):
     assert response.status_code == 201
 
 
+@pytest.mark.django_db
+def test_update_status_code_existing_no_update_gzip(client):
+    """Updating an existing host with a correct gzip-compressed payload should return 201 Created."""
+    response = client.generic('POST', EXISTING_HOST_UPDATE_URL, gzip.compress(PAYLOAD_EXISTING_NO_UPDATE.encode()),
+                              HTTP_CONTENT_ENCODING='gzip')
+    assert response.status_code == 201
+
+
 @pytest.mark.django_db
 def test_update_status_code_existing_update(client):
     """Updating an existing host with a correct payload with updates should return 201 Created."""
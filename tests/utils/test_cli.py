@@ -1,28 +1,35 @@
+import functools
+import gzip
+import io
 import json
+import logging
 import os
-import sys
+import types
 
 from collections import namedtuple
-from unittest.mock import MagicMock, mock_open, patch
+from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 
-OS_NAME = 'ExampleOS'
+
+OS_NAME = 'Example'
 KERNEL_RELEASE = '1.0.0'
 KERNEL_VERSION = 'ExampleOS v1.0.0-1'
-mocked_apt = MagicMock()
-mocked_apt.cache.Filter = object
-mocked_lsb = MagicMock()
-mocked_lsb.get_distro_information().get.return_value = OS_NAME
-mocked_platform = MagicMock()
-mocked_platform.release.return_value = KERNEL_RELEASE
-mocked_platform.version.return_value = KERNEL_VERSION
-with patch.dict(sys.modules, {'apt': mocked_apt, 'lsb_release': mocked_lsb, 'platform': mocked_platform}):
-    from utils import cli
-
-
-AptPackage = namedtuple('AptPackage', ['name', 'is_installed', 'installed', 'candidate'])
 AptPkgVersion = namedtuple('AptPkgVersion', ['source_name', 'version'])
+
+
+class AptPackage(namedtuple('AptPackage', ['name', 'is_installed', 'installed', 'candidate'])):
+    """Lightweight replacement of apt.package.Package."""
+
+    __slots__ = ()
+
+    @property
+    def is_upgradable(self):
+        """Return True if the package is installed and has a different candidate version."""
+        return self.is_installed and self.candidate is not None and self.candidate != self.installed
+
+
 HOSTNAME = 'host1.example.com'
 DEBMONITOR_SERVER = 'debmonitor.example.com'
 DEBMONITOR_BASE_URL = 'https://{server}:443'.format(server=DEBMONITOR_SERVER)
@@ -31,7 +38,7 @@ DEBMONITOR_CLIENT_URL = '{base_url}/client'.format(base_url=DEBMONITOR_BASE_URL)
 DEBMONITOR_CLIENT_VERSION = '0.0.1'
 DEBMONITOR_CLIENT_CHECKSUM = '8d777f385d3dfec8815d20f7496026dc'
 APT_HOOK_LINES = {
-    2: [
+    2: (
         # Installed
         'package-name - < 1.0.0-1 /var/cache/apt/archives/package-name_1.0.0-1_all.deb\n',
         'package-name - < 1.0.0-1 **CONFIGURE**\n',
@@ -46,8 +53,8 @@ APT_HOOK_LINES = {
         'package-name 1.0.0-2 > 1.0.0-1 **CONFIGURE**\n',
         # Removed
         'package-name 1.0.0-1 > - **REMOVE**\n',
-    ],
-    3: [
+    ),
+    3: (
         # Installed
         'package-name - - none < 1.0.0-1 all none /var/cache/apt/archives/package-name_1.0.0-1_all.deb\n',
         'package-name - - none < 1.0.0-1 all none **CONFIGURE**\n',
@@ -62,7 +69,25 @@ APT_HOOK_LINES = {
         'package-name 1.0.0-2 all none > 1.0.0-1 all none **CONFIGURE**\n',
         # Removed
         'package-name 1.0.0-1 all none > - - none **REMOVE**\n',
-    ]
+    ),
+}
+SELF_UPDATE_FAILURES = (
+    # (HEAD status code, remote version, GET status code, remote checksum, expected error message)
+    pytest.param(500, None, None, None, 'Unable to check remote script version', id='head_fail'),
+    pytest.param(200, None, None, None, 'No header X-Debmonitor-Client-Version value found', id='head_no_header'),
+    pytest.param(200, DEBMONITOR_CLIENT_VERSION, 500, None, 'Unable to download remote script', id='get_fail'),
+    pytest.param(200, DEBMONITOR_CLIENT_VERSION, 200, '000000',
+                 'The checksum of the script do not match the HTTP header', id='wrong_hash'),
+)
+DPKG_HOOK_PREAMBLE = {
+    version: (
+        'VERSION {version}\n'.format(version=version),
+        'APT::Architecture=amd64\n',
+        'APT::Build-Essential::=build-essential\n',
+        'APT::Install-Recommends=0\n',
+        'APT::Install-Suggests=0\n',
+        '\n',
+    ) for version in (2, 3)
 }
 APT_LINES_TO_PARSE = [
     # (proto version, apt hook line index, expected group, expected package name, expected package version)
@@ -95,44 +120,205 @@ APT_LINES_TO_PARSE = [
     # Removed
     (3, 8, 'uninstalled', 'package-name', '1.0.0-1'),
 ]
-APT_PACKAGES = [
+APT_PACKAGES = (
     AptPackage(name='package1', is_installed=True, installed=AptPkgVersion(source_name='package1', version='1.0.0-1'),
-               candidate=None),
+               candidate=AptPkgVersion(source_name='package1', version='1.0.0-2')),
     AptPackage(name='package21', is_installed=True, installed=AptPkgVersion(source_name='package2', version='1.0.0-1'),
                candidate=None),
     AptPackage(name='package22', is_installed=True, installed=AptPkgVersion(source_name='package2', version='1.0.0-1'),
                candidate=None),
     AptPackage(name='package3', is_installed=True, installed=AptPkgVersion(source_name='package31', version='1.0.0-1'),
-               candidate=None),
-]
-APT_UPGRADES = [
+               candidate=AptPkgVersion(source_name='package32', version='1.0.0-2')),
+)
+APT_UPGRADES = (
     AptPackage(name='package1', is_installed=True, installed=AptPkgVersion(source_name='package1', version='1.0.0-1'),
                candidate=AptPkgVersion(source_name='package1', version='1.0.0-2')),
     AptPackage(name='package3', is_installed=True, installed=AptPkgVersion(source_name='package31', version='1.0.0-1'),
                candidate=AptPkgVersion(source_name='package32', version='1.0.0-2')),
     AptPackage(name='package9', is_installed=False, installed=None, candidate=AptPkgVersion(
                source_name='package9', version='1.0.0-2')),
-]
-CLI_UPGRADES = [
+)
+CLI_UPGRADES = (
     {'name': 'package1', 'version_from': '1.0.0-1', 'version_to': '1.0.0-2', 'source': 'package1'},
     {'name': 'package3', 'version_from': '1.0.0-1', 'version_to': '1.0.0-2', 'source': 'package32'},
-]
-CLI_PACKAGES = [
+)
+CLI_PACKAGES = (
     {'name': 'package1', 'version': '1.0.0-1', 'source': 'package1'},
     {'name': 'package21', 'version': '1.0.0-1', 'source': 'package2'},
     {'name': 'package22', 'version': '1.0.0-1', 'source': 'package2'},
     {'name': 'package3', 'version': '1.0.0-1', 'source': 'package31'},
-]
+)
+
+
+class FakeFile:
+    """Lightweight replacement of open() that records how a file was opened and the data written to it.
+
+    Any other file is opened with the original open().
+    """
+
+    def __init__(self, path):
+        """Initialize the path of the file to fake, the recorded calls and written data."""
+        self.path = path
+        self.opened = []
+        self.written = []
+        self.open = open
+
+    def __call__(self, path, *args, **kwargs):
+        """Record the call to open() and return itself as file object if path is the one to fake."""
+        if path != self.path:
+            return self.open(path, *args, **kwargs)
+
+        self.opened.append(((path,) + args, kwargs))
+        return self
+
+    def __enter__(self):
+        """Return itself as file object."""
+        return self
+
+    def __exit__(self, *args):
+        """Nothing to close."""
+
+    def write(self, data):
+        """Record the written data."""
+        self.written.append(data)
+
+
+class FakeFilteredCache:
+    """Lightweight replacement of apt.cache.FilteredCache with pre-defined installed packages and upgrades."""
+
+    __slots__ = ('installed', 'upgrades')
+
+    def __init__(self, installed, upgrades):
+        """Set the installed packages and the upgrades."""
+        self.installed = installed
+        self.upgrades = upgrades
+
+    def __iter__(self):
+        """Iterate over the installed packages."""
+        return iter(self.installed)
+
+    def __len__(self):
+        """Return the number of installed packages."""
+        return len(self.installed)
+
+    def set_filter(self, filter):
+        """The packages are already filtered."""
+
+    def upgrade(self, dist_upgrade=False):
+        """The upgrades are already computed."""
+
+    def get_changes(self):
+        """Return the upgrades."""
+        return self.upgrades
+
+
+@pytest.fixture(scope='module')
+def cli(cli_module, tmpdir_factory):
+    """Return the DebMonitor CLI module with an os-release file with the above pre-defined OS name.
+
+    The packages and hostname caches are disabled, see the packages_cache and hostname_cache fixtures to enable them.
+    """
+    os_release = tmpdir_factory.mktemp('etc').join('os-release')
+    os_release.write('PRETTY_NAME="Example OS"\nNAME="Example OS"\nID={name}\n'.format(name=OS_NAME.lower()))
+    cli_module.OS_RELEASE_PATH = str(os_release)
+    cli_module.PACKAGES_CACHE_DIR = None
+    cli_module.HOSTNAME_CACHE_PATH = None
+    return cli_module
+
+
+@pytest.fixture()
+def hostname_cache(cli, tmpdir, monkeypatch):
+    """Enable the hostname cache in a temporary directory and return the path of the cache file.
+
+    The hostname of the host is the short one.
+    """
+    path = tmpdir.join('debmonitor.fqdn')
+    monkeypatch.setattr(cli, 'HOSTNAME_CACHE_PATH', str(path))
+    monkeypatch.setattr(cli.socket, 'gethostname', lambda: HOSTNAME.split('.')[0])
+    return path
+
+
+@pytest.fixture(autouse=True)
+def mocked_uname(cli, monkeypatch):
+    """Make os.uname() return the above pre-defined kernel release and version."""
+    monkeypatch.setattr(cli.os, 'uname', lambda: ('Linux', HOSTNAME, KERNEL_RELEASE, KERNEL_VERSION, 'x86_64'))
+
 
+@pytest.fixture()
+def mocked_apt(cli):
+    """Return the mocked apt module used by the DebMonitor CLI."""
+    return cli.apt
 
-def test_parse_args_ok():
+
+@pytest.fixture()
+def packages_cache(cli, tmpdir, monkeypatch):
+    """Enable the packages cache in a temporary directory, with empty dpkg status, APT lists and preferences files."""
+    tmpdir.join('status').write('')
+    lists = tmpdir.mkdir('lists')
+    lists.join('example.com_debian_dists_stable_main_binary-amd64_Packages').write('')
+    lists.join('example.com_debian_dists_stable_contrib_binary-amd64_Packages.lz4').write('')
+    tmpdir.join('preferences').write('')
+    tmpdir.mkdir('preferences.d')
+    monkeypatch.setattr(cli, 'PACKAGES_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setattr(cli, 'DPKG_STATUS_PATH', str(tmpdir.join('status')))
+    monkeypatch.setattr(cli, 'APT_LISTS_PATTERN', str(tmpdir.join('lists', '*_Packages*')))
+    monkeypatch.setattr(cli, 'APT_PREFERENCES_PATTERNS',
+                        (str(tmpdir.join('preferences')), str(tmpdir.join('preferences.d', '*'))))
+    return tmpdir
+
+
+@pytest.fixture(scope='module')
+def filtered_caches():
+    """Build once per module the mocked apt filtered caches, with the pre-defined packages and without packages."""
+    return {'full': FakeFilteredCache(APT_PACKAGES, APT_UPGRADES), 'empty': FakeFilteredCache([], [])}
+
+
+@pytest.fixture()
+def apt_caches(mocked_apt, filtered_caches):
+    """Set the mocked apt filtered cache with the pre-defined packages."""
+    original = mocked_apt.cache.FilteredCache.return_value
+    mocked_apt.cache.FilteredCache.return_value = filtered_caches['full']
+    yield filtered_caches['full']
+    mocked_apt.cache.FilteredCache.return_value = original
+
+
+@pytest.fixture()
+def empty_apt_caches(mocked_apt, filtered_caches):
+    """Set the mocked apt filtered cache without packages."""
+    original = mocked_apt.cache.FilteredCache.return_value
+    mocked_apt.cache.FilteredCache.return_value = filtered_caches['empty']
+    yield filtered_caches['empty']
+    mocked_apt.cache.FilteredCache.return_value = original
+
+
+@pytest.fixture()
+def preregistered_requests(mocked_requests):
+    """Return the mocked requests with the successful POST of the update to the DebMonitor server already registered."""
+    mocked_requests.register_uri('POST', DEBMONITOR_UPDATE_URL, status_code=201)
+    return mocked_requests
+
+
+@pytest.fixture()
+def parsed_args(cli, params):
+    """Return the parsed CLI arguments for the DebMonitor server and the parameters of the test."""
+    return _parse_args(cli, tuple(params))
+
+
+@pytest.fixture(params=APT_LINES_TO_PARSE, ids=lambda p: 'v{ver}-{idx}'.format(ver=p[0], idx=p[1]))
+def apt_parse_case(request):
+    """Return a tuple (line, version, group, name, package version) for each of the APT_LINES_TO_PARSE."""
+    version, index, group, name, package_version = request.param
+    return APT_HOOK_LINES[version][index], version, group, name, package_version
+
+
+def test_parse_args_ok(cli):
     """Calling parse_args with correct parameters should return the parsed arguments."""
     server = 'localhost'
     args = cli.parse_args(['-s', server])
     assert args.server == server
 
 
-def test_parse_args_missing_server(capsys):
+def test_parse_args_missing_server(capsys, cli):
     """Calling parse_args without a -s/--server parameter should raise an error if -n/--dry-run is not set."""
     with pytest.raises(SystemExit):
         cli.parse_args([])
@@ -140,13 +326,13 @@ def test_parse_args_missing_server(capsys):
     assert 'argument -s/--server is required unless -n/--dry-run is set' in err
 
 
-def test_parse_args_missing_server_dry_run():
+def test_parse_args_missing_server_dry_run(cli):
     """Calling parse_args without a -s/--server parameter should not raise an error if -n/--dry-run is set."""
     args = cli.parse_args(['-n'])
     assert args.dry_run
 
 
-def test_parse_args_key_with_no_cert(capsys):
+def test_parse_args_key_with_no_cert(capsys, cli):
     """Calling parse_args with -k/--key but without -c/--cert should raise an error."""
     with pytest.raises(SystemExit):
         cli.parse_args(['-n', '-k', 'keypath'])
@@ -154,7 +340,7 @@ def test_parse_args_key_with_no_cert(capsys):
     assert 'argument -c/--cert is required when -k/--key is set' in err
 
 
-def test_parse_args_upgradable_dpkg(capsys):
+def test_parse_args_upgradable_dpkg(capsys, cli):
     """Calling parse_args with both -u/--upgradable and -g/--dpkg should raise an error."""
     with pytest.raises(SystemExit):
         cli.parse_args(['-n', '-u', '-g'])
@@ -162,7 +348,7 @@ def test_parse_args_upgradable_dpkg(capsys):
     assert 'argument -u/--upgradable and -g/--dpkg-hook are mutually exclusive' in err
 
 
-def test_parse_args_version(capsys):
+def test_parse_args_version(capsys, cli):
     """Calling parse_args with --version should print the version and exit."""
     with pytest.raises(SystemExit):
         cli.parse_args(['--version'])
@@ -170,26 +356,79 @@ def test_parse_args_version(capsys):
     assert 'debmonitor {ver}'.format(ver=cli.__version__) in out
 
 
-def test_parse_apt_line_wrong_version():
+def test_parse_apt_line_wrong_version(cli):
     """Calling parse_apt_line with the wrong version should raise RuntimeError."""
     with pytest.raises(RuntimeError, match='Unsupported version'):
         cli.parse_apt_line('line', None, version=1)
 
 
-@pytest.mark.parametrize('params', APT_LINES_TO_PARSE)
-def test_parse_apt_lines(params):
+@pytest.mark.parametrize('version', (2, 3))
+def test_parse_apt_line_malformed(version, cli):
+    """Calling parse_apt_line with a line in an unexpected format should raise RuntimeError."""
+    with pytest.raises(RuntimeError, match='Unable to parse line: package-name 1.0.0-1'):
+        cli.parse_apt_line('package-name 1.0.0-1\n', None, version=version)
+
+
+@pytest.mark.parametrize('line, expected', (
+    ('package-name 1.0.0-1 < 1.0.0-2 **CONFIGURE**\n', True),
+    ('package-name 1.0.0-1 < 1.0.0-2 **CONFIGURE**', True),
+    ('package-name 1.0.0-1 < 1.0.0-2 **CONFIGURE**  \r\n', True),
+    ('package-name 1.0.0-1 > - **REMOVE**\n', False),
+    ('**CONFIGURE**-package 1.0.0-1 < 1.0.0-2 /var/cache/apt/archives/package_1.0.0-2_all.deb\n', False),
+))
+def test_is_configure_line(line, expected, cli):
+    """Calling is_configure_line() should detect the lines to configure a package, with any trailing whitespaces."""
+    assert cli.is_configure_line(line) is expected
+
+
+@pytest.mark.parametrize('version', (2, 3))
+def test_match_apt_change(version, cli):
+    """Calling match_apt_change() should return the matched groups only for the lines with a package change."""
+    match_line = cli.APT_LINE_PATTERNS[version].match
+    changes = [cli.match_apt_change(line, match_line) for line in APT_HOOK_LINES[version]]
+    assert changes == [
+        ('package-name', '-', '<', '1.0.0-1'), None,  # Installed
+        None, None,  # Re-installed
+        ('package-name', '1.0.0-1', '<', '1.0.0-2'), None,  # Upgraded
+        ('package-name', '1.0.0-2', '>', '1.0.0-1'), None,  # Downgraded
+        ('package-name', '1.0.0-1', '>', '-'),  # Removed
+    ]
+
+
+def test_parse_apt_lines(apt_parse_case, cli):
     """Calling parse_apt_line with multiple lines and ensure that the result is the expected one."""
-    group, package = cli.parse_apt_line(
-        APT_HOOK_LINES[params[0]][params[1]], mocked_apt.cache.Cache(), version=params[0])
-    assert group == params[2]
-    if params[3] is None:
+    line, version, expected_group, expected_name, expected_version = apt_parse_case
+    group, package = cli.parse_apt_line(line, {'package-name': ('source-candidate', 'source-installed')},
+                                        version=version)
+    assert group == expected_group
+    if expected_name is None:
         assert package is None
     else:
-        assert package['name'] == params[3]
-        assert package['version'] == params[4]
+        assert package['name'] == expected_name
+        assert package['version'] == expected_version
+        if group == 'uninstalled':
+            assert package['source'] == 'source-installed'
+        else:
+            assert package['source'] == 'source-candidate'
+
+
+@pytest.mark.parametrize('level', (logging.DEBUG, logging.INFO))
+def test_parse_apt_line_debug(level, caplog, cli):
+    """Calling parse_apt_line() should log the collected package only if the debug logging is enabled."""
+    with caplog.at_level(level, logger='debmonitor'):
+        cli.parse_apt_line(APT_HOOK_LINES[3][8], {'package-name': ('source-candidate', 'source-installed')})
+
+    assert ('Collected removed package: ' in caplog.text) is (level == logging.DEBUG)
 
 
-def test_apt_filter_installed():
+def test_get_source_names(cli):
+    """Calling get_source_names() should return the source names of the candidate and installed versions."""
+    cache = {pkg.name: pkg for pkg in APT_UPGRADES}
+    sources = cli.get_source_names(cache, {'package3', 'package9'})
+    assert sources == {'package3': ('package32', 'package31'), 'package9': ('package9', None)}
+
+
+def test_apt_filter_installed(cli):
     """Calling AptInstalledFilter.apply() with an installed package should return True."""
     filter = cli.AptInstalledFilter()
     package = MagicMock()
@@ -197,7 +436,7 @@ def test_apt_filter_installed():
     assert filter.apply(package)
 
 
-def test_apt_filter_not_installed():
+def test_apt_filter_not_installed(cli):
     """Calling AptInstalledFilter.apply() with a not installed package should return False."""
     filter = cli.AptInstalledFilter()
     package = MagicMock()
@@ -205,25 +444,144 @@ def test_apt_filter_not_installed():
     assert filter.apply(package) is False
 
 
+def test_strings_pool(cli):
+    """Looking up equal strings in a StringsPool should always return the first one seen."""
+    pool = cli.StringsPool()
+    first = ''.join(['package', '1'])
+    second = ''.join(['package', '1'])
+    assert first is not second
+    assert pool[first] is first
+    assert pool[second] is first
+    assert len(pool) == 1
+
+
 @pytest.mark.parametrize('upgradable_only', (False, True))
-def test_get_packages_empty(upgradable_only):
+def test_get_packages_empty(upgradable_only, empty_apt_caches, cli):
     """Calling get_packages() with apt cache without pacakges should return a dictionary of empty lists."""
     packages = cli.get_packages(upgradable_only=upgradable_only)
     assert packages == {'installed': [], 'upgradable': [], 'uninstalled': []}
 
 
 @pytest.mark.parametrize('upgradable_only', (False, True))
-def test_get_packages(upgradable_only):
+def test_get_packages(upgradable_only, apt_caches, cli):
     """Calling get_packages() should return a dictionary of list of packages."""
-    _reset_apt_caches()
     packages = cli.get_packages(upgradable_only=upgradable_only)
     if upgradable_only:
-        assert packages == {'installed': [], 'upgradable': CLI_UPGRADES, 'uninstalled': []}
+        assert packages == {'installed': [], 'upgradable': list(CLI_UPGRADES), 'uninstalled': []}
     else:
-        assert packages == {'installed': CLI_PACKAGES, 'upgradable': CLI_UPGRADES, 'uninstalled': []}
+        assert packages == {'installed': list(CLI_PACKAGES), 'upgradable': list(CLI_UPGRADES), 'uninstalled': []}
+
+
+def test_get_packages_no_upgrades(mocked_apt, monkeypatch, cli):
+    """Calling get_packages() without upgradable packages should not run the APT resolver."""
+    cache = FakeFilteredCache([pkg._replace(candidate=None) for pkg in APT_PACKAGES], APT_UPGRADES)
+    monkeypatch.setattr(mocked_apt.cache.FilteredCache, 'return_value', cache)
+
+    with patch.object(FakeFilteredCache, 'upgrade') as mocked_upgrade:
+        packages = cli.get_packages()
+
+    assert not mocked_upgrade.called
+    assert packages == {'installed': list(CLI_PACKAGES), 'upgradable': [], 'uninstalled': []}
+
+
+@pytest.mark.parametrize('level', (logging.DEBUG, logging.INFO))
+def test_get_packages_debug(level, caplog, apt_caches, cli):
+    """Calling get_packages() should log each collected package only if the debug logging is enabled."""
+    with caplog.at_level(level, logger='debmonitor'):
+        cli.get_packages()
+
+    debug = level == logging.DEBUG
+    assert caplog.text.count('Collected installed: ') == len(CLI_PACKAGES) * debug
+    assert caplog.text.count('Collected upgrade: ') == len(CLI_UPGRADES) * debug
+
+
+@pytest.mark.parametrize('upgradable_only', (False, True))
+def test_get_packages_cached(upgradable_only, apt_caches, packages_cache, cli):
+    """Calling get_packages() again without changes to dpkg and APT lists should return the cached packages."""
+    packages = cli.get_packages(upgradable_only=upgradable_only)
+
+    with patch.object(cli, 'collect_packages') as mocked_collect_packages:
+        assert cli.get_packages(upgradable_only=upgradable_only) == packages
+
+    assert not mocked_collect_packages.called
+    assert len(packages_cache.join('cache').listdir()) == 1
+
+
+@pytest.mark.parametrize('path', (
+    'status',
+    'lists',
+    'lists/example.com_debian_dists_stable_main_binary-amd64_Packages',
+    'lists/example.com_debian_dists_stable_contrib_binary-amd64_Packages.lz4',
+    'preferences',
+))
+def test_get_packages_cache_stale(path, apt_caches, packages_cache, cli):
+    """Calling get_packages() again after a change to dpkg, APT lists or preferences should collect them again."""
+    packages = cli.get_packages()
+    changed = packages_cache.join(path)
+    changed.setmtime(changed.mtime() + 10)
+
+    with patch.object(cli, 'collect_packages', return_value=packages) as mocked_collect_packages:
+        assert cli.get_packages() == packages
+
+    mocked_collect_packages.assert_called_once_with(upgradable_only=False)
+
+
+@pytest.mark.parametrize('path', ('lists/example.com_debian_dists_stable_non-free_binary-amd64_Packages.gz',
+                                  'preferences.d/pinning.pref'))
+def test_get_packages_cache_new_file(path, apt_caches, packages_cache, cli):
+    """Calling get_packages() again after a new APT list or preferences file is added should collect them again."""
+    packages = cli.get_packages()
+    lists = packages_cache.join('lists')
+    lists_mtime = lists.mtime()
+    packages_cache.join(path).write('')
+    lists.setmtime(lists_mtime)  # Detect the new file also without the change of the directory
+
+    with patch.object(cli, 'collect_packages', return_value=packages) as mocked_collect_packages:
+        assert cli.get_packages() == packages
 
+    mocked_collect_packages.assert_called_once_with(upgradable_only=False)
 
-def test_parse_dpkg_hook_no_version():
+
+def test_get_packages_cache_no_state(apt_caches, packages_cache, cli):
+    """Calling get_packages() when the dpkg status is missing should collect the packages without caching them."""
+    packages_cache.join('status').remove()
+    assert cli.get_packages()['installed'] == list(CLI_PACKAGES)
+    assert not packages_cache.join('cache').check()
+
+
+def test_get_packages_cache_invalid(apt_caches, packages_cache, cli):
+    """Calling get_packages() with an invalid cache file should collect the packages again and overwrite it."""
+    packages_cache.mkdir('cache').join('packages-full.json').write('invalid')
+    assert cli.get_packages()['installed'] == list(CLI_PACKAGES)
+    assert json.loads(packages_cache.join('cache', 'packages-full.json').read())['packages']['installed'] == list(
+        CLI_PACKAGES)
+
+
+def test_get_packages_cache_not_writable(apt_caches, packages_cache, cli):
+    """Calling get_packages() when unable to write the cache should log it and return the packages anyway."""
+    packages_cache.join('cache').write('not a directory')
+    assert cli.get_packages()['installed'] == list(CLI_PACKAGES)
+
+
+def test_write_file_atomically(tmpdir, cli):
+    """Calling write_file_atomically() should replace the file without leaving temporary files around."""
+    path = tmpdir.join('file')
+    path.write('old')
+    cli.write_file_atomically(str(path), 'new')
+    assert path.read() == 'new'
+    assert tmpdir.listdir() == [path]
+
+
+def test_write_file_atomically_fail(tmpdir, cli):
+    """Calling write_file_atomically() should remove the temporary file if unable to rename it."""
+    path = tmpdir.mkdir('directory')
+    with pytest.raises(EnvironmentError):
+        cli.write_file_atomically(str(path), 'content')
+
+    assert tmpdir.listdir() == [path]
+
+
+def test_parse_dpkg_hook_no_version(cli):
     """Calling parse_dpkg_hook() with a wrongly formatted version line should raise RuntimeError."""
     with pytest.raises(RuntimeError, match='Expected VERSION line to be the first one'):
         input_lines = [
@@ -233,17 +591,24 @@ def test_parse_dpkg_hook_no_version():
         cli.parse_dpkg_hook(input_lines)
 
 
-def test_parse_dpkg_hook_wrong_version():
+def test_parse_dpkg_hook_empty(cli):
+    """Calling parse_dpkg_hook() with an empty input should raise RuntimeError."""
+    with pytest.raises(RuntimeError, match='Expected VERSION line to be the first one'):
+        cli.parse_dpkg_hook(io.StringIO(''))
+
+
+@pytest.mark.parametrize('version', ('4', '13', '3a', ''))
+def test_parse_dpkg_hook_wrong_version(version, cli):
     """Calling parse_dpkg_hook() with an unsupported version line should raise RuntimeError."""
     input_lines = [
-        'VERSION 4\n',
+        'VERSION {ver}\n'.format(ver=version),
         'APT::Architecture=amd64\n',
     ]
     with pytest.raises(RuntimeError, match='Unsupported version'):
         cli.parse_dpkg_hook(input_lines)
 
 
-def test_parse_dpkg_hook_no_separator():
+def test_parse_dpkg_hook_no_separator(cli):
     """Calling parse_dpkg_hook() with no empty separator should raise a RuntimeError."""
     input_lines = [
         'VERSION 3\n',
@@ -253,7 +618,18 @@ def test_parse_dpkg_hook_no_separator():
         cli.parse_dpkg_hook(input_lines)
 
 
-def test_parse_dpkg_hook_no_packages():
+@pytest.mark.parametrize('line', ('garbage line\n', '\n'))
+def test_parse_dpkg_hook_malformed(line, mocked_apt, cli):
+    """Calling parse_dpkg_hook() with a malformed line should raise RuntimeError without loading the apt cache."""
+    mocked_apt.cache.Cache.reset_mock()
+    input_lines = list(DPKG_HOOK_PREAMBLE[3]) + [APT_HOOK_LINES[3][0], line]
+    with pytest.raises(RuntimeError, match='Unable to parse line: '):
+        cli.parse_dpkg_hook(input_lines)
+
+    assert not mocked_apt.cache.Cache.called
+
+
+def test_parse_dpkg_hook_no_packages(cli):
     """Calling parse_dpkg_hook() with no update lines should return an empty dictionary."""
     input_lines = [
         'VERSION 3\n',
@@ -263,6 +639,17 @@ def test_parse_dpkg_hook_no_packages():
     assert cli.parse_dpkg_hook(input_lines) == {}
 
 
+@pytest.mark.parametrize('version', (2, 3))
+@pytest.mark.parametrize('indexes', ((1, 2), (2, 4), (3, 4)))
+def test_parse_dpkg_hook_no_changes(version, indexes, mocked_apt, cli):
+    """Calling parse_dpkg_hook() with only packages to configure or re-install should not load the apt cache."""
+    input_lines = list(DPKG_HOOK_PREAMBLE[version] + APT_HOOK_LINES[version][indexes[0]:indexes[1]])
+    with patch.object(mocked_apt.cache, 'Cache') as mocked_cache:
+        assert cli.parse_dpkg_hook(input_lines) == {}
+
+    assert not mocked_cache.called
+
+
 @pytest.mark.parametrize('version', (2, 3))
 @pytest.mark.parametrize('apt_line', (
     # APT_HOOK_LINES start index, APT_HOOK_LINES end index, apt cache package
@@ -279,17 +666,17 @@ def test_parse_dpkg_hook_no_packages():
     (8, 9, AptPackage(name='package-name', is_installed=True,
                       installed=AptPkgVersion(source_name='package-name', version='1.0.0-1'), candidate=None)),
 ))
-def test_parse_dpkg_hook(version, apt_line):
+def test_parse_dpkg_hook(version, apt_line, mocked_apt, cli):
     """Calling parse_dpkg_hook() should parse the list of packages reported by a Dpkg::Pre-Install-Pkgs hook."""
     mocked_apt.cache.Cache().__getitem__.return_value = apt_line[2]
-    input_lines = _get_dpkg_hook_preamble(version) + APT_HOOK_LINES[version][apt_line[0]:apt_line[1]]
+    input_lines = list(DPKG_HOOK_PREAMBLE[version] + APT_HOOK_LINES[version][apt_line[0]:apt_line[1]])
 
     packages = cli.parse_dpkg_hook(input_lines)
 
     expected_packages = {'installed': [], 'upgradable': [], 'uninstalled': []}
     package = {'name': 'package-name', 'version': '', 'source': 'package-name'}
     if apt_line[0] == 2:
-        pass  # Re-installed package, no changes
+        expected_packages = {}  # Re-installed package, no changes
     elif apt_line[0] == 8:
         package['version'] = apt_line[2].installed.version
         expected_packages['uninstalled'].append(package)
@@ -300,62 +687,136 @@ def test_parse_dpkg_hook(version, apt_line):
     assert packages == expected_packages
 
 
-def test_self_update_head_fail(mocked_requests):
-    """Calling self_update() when the HEAD request to DebMonitor fail should raise RuntimeError."""
-    mocked_requests.register_uri('HEAD', DEBMONITOR_CLIENT_URL, status_code=500)
-    with pytest.raises(RuntimeError, match='Unable to check remote script version'):
-        cli.self_update(DEBMONITOR_BASE_URL, None)
+def test_serialize_payload(monkeypatch, cli):
+    """Calling serialize_payload() without orjson should return the JSON-encoded payload."""
+    monkeypatch.setattr(cli, 'orjson', None)
+    assert json.loads(cli.serialize_payload(EXPECTED_PAYLOAD_FULL.copy()).decode('utf-8')) == EXPECTED_PAYLOAD_FULL
 
-    assert mocked_requests.called
 
+def test_serialize_payload_orjson(monkeypatch, cli):
+    """Calling serialize_payload() with orjson available should use it to encode the payload."""
+    mocked_orjson = MagicMock()
+    monkeypatch.setattr(cli, 'orjson', mocked_orjson)
+    assert cli.serialize_payload({'key': 'value'}) is mocked_orjson.dumps.return_value
+    mocked_orjson.dumps.assert_called_once_with({'key': 'value'})
 
-def test_self_update_head_no_header(mocked_requests):
-    """Calling self_update() when the HEAD request is missing the expected header should raise RuntimeError."""
-    mocked_requests.register_uri('HEAD', DEBMONITOR_CLIENT_URL, status_code=200)
-    with pytest.raises(RuntimeError, match='No header {header} value found'.format(header=cli.CLIENT_VERSION_HEADER)):
-        cli.self_update(DEBMONITOR_BASE_URL, None)
 
-    assert mocked_requests.called
+def test_compress_payload(cli):
+    """Calling compress_payload() should return the gzip-compressed payload."""
+    body = json.dumps(EXPECTED_PAYLOAD_FULL.copy()).encode('utf-8')
+    assert gzip.decompress(cli.compress_payload(body)) == body
 
 
-def test_self_update_head_same_version(mocked_requests):
-    """Calling self_update() when client on DebMonitor is at the same version should return without doing anything."""
-    mocked_requests.register_uri(
-        'HEAD', DEBMONITOR_CLIENT_URL, status_code=200, headers={cli.CLIENT_VERSION_HEADER: cli.__version__})
+def test_get_session(cli):
+    """Calling get_session() should always return the same requests session."""
+    session = cli.get_session()
+    assert isinstance(session, requests.Session)
+    assert cli.get_session() is session
 
-    ret = cli.self_update(DEBMONITOR_BASE_URL, None)
 
-    assert ret is None
-    assert mocked_requests.called
+@pytest.mark.parametrize('content, expected', (
+    ('NAME="Debian GNU/Linux"\nID=debian\n', 'Debian'),
+    ('NAME="Ubuntu"\nID="ubuntu"\nID_LIKE=debian\n', 'Ubuntu'),
+    ('NAME="Example OS"\n', 'unknown'),
+))
+def test_get_os_name(content, expected, tmpdir, monkeypatch, cli):
+    """Calling get_os_name() should return the capitalized ID from the os-release file."""
+    os_release = tmpdir.join('os-release')
+    os_release.write(content)
+    monkeypatch.setattr(cli, 'OS_RELEASE_PATH', str(os_release))
+    assert cli.get_os_name() == expected
 
 
-def test_self_update_has_update_fail(mocked_requests):
-    """Calling self_update() when the GET request to DebMonitor fail should raise RuntimeError."""
-    mocked_requests.register_uri(
-        'HEAD', DEBMONITOR_CLIENT_URL, status_code=200, headers={cli.CLIENT_VERSION_HEADER: DEBMONITOR_CLIENT_VERSION})
-    mocked_requests.register_uri('GET', DEBMONITOR_CLIENT_URL, status_code=500)
+@patch('socket.getfqdn', return_value=HOSTNAME)
+def test_get_hostname_no_cache(mocked_getfqdn, cli):
+    """Calling get_hostname() with the hostname cache disabled should resolve the FQDN every time."""
+    assert cli.get_hostname() == HOSTNAME
+    assert cli.get_hostname() == HOSTNAME
+    assert mocked_getfqdn.call_count == 2
+
+
+@patch('socket.getfqdn', return_value=HOSTNAME)
+def test_get_hostname_cached(mocked_getfqdn, hostname_cache, cli):
+    """Calling get_hostname() should resolve the FQDN only the first time and cache it for the next calls."""
+    assert cli.get_hostname() == HOSTNAME
+    assert cli.get_hostname() == HOSTNAME
+    mocked_getfqdn.assert_called_once_with()
+    assert hostname_cache.read() == HOSTNAME
+
+
+@patch('socket.getfqdn', return_value=HOSTNAME)
+def test_get_hostname_cache_empty(mocked_getfqdn, hostname_cache, cli):
+    """Calling get_hostname() with an empty hostname cache should resolve the FQDN again."""
+    hostname_cache.write('\n')
+    assert cli.get_hostname() == HOSTNAME
+    mocked_getfqdn.assert_called_once_with()
+    assert hostname_cache.read() == HOSTNAME
+
+
+@pytest.mark.parametrize('fqdn, hostname', (
+    ('host1', 'host1'),  # Failed resolution, fallback to the short hostname
+    (HOSTNAME, HOSTNAME),  # Failed resolution or not, can't tell
+))
+def test_get_hostname_not_cached(fqdn, hostname, hostname_cache, monkeypatch, cli):
+    """Calling get_hostname() should not cache the name if it might be the fallback of a failed FQDN resolution."""
+    mocked_getfqdn = MagicMock(return_value=fqdn)
+    monkeypatch.setattr(cli.socket, 'getfqdn', mocked_getfqdn)
+    monkeypatch.setattr(cli.socket, 'gethostname', lambda: hostname)
+
+    assert cli.get_hostname() == fqdn
+    assert cli.get_hostname() == fqdn
+    assert mocked_getfqdn.call_count == 2
+    assert not hostname_cache.check()
+
 
-    with pytest.raises(RuntimeError, match='Unable to download remote script'):
+@patch('socket.getfqdn', return_value=HOSTNAME)
+def test_get_hostname_cache_not_writable(mocked_getfqdn, hostname_cache, tmpdir, monkeypatch, cli):
+    """Calling get_hostname() should return the FQDN also if unable to cache it."""
+    monkeypatch.setattr(cli, 'HOSTNAME_CACHE_PATH', str(tmpdir.join('missing', 'debmonitor.fqdn')))
+    assert cli.get_hostname() == HOSTNAME
+    assert cli.get_hostname() == HOSTNAME
+    assert mocked_getfqdn.call_count == 2
+
+
+def test_get_os_name_missing(tmpdir, monkeypatch, cli):
+    """Calling get_os_name() without an os-release file should return 'unknown'."""
+    monkeypatch.setattr(cli, 'OS_RELEASE_PATH', str(tmpdir.join('os-release')))
+    assert cli.get_os_name() == 'unknown'
+
+
+@pytest.mark.parametrize('head_status, version, get_status, checksum, message', SELF_UPDATE_FAILURES)
+def test_self_update_fail(head_status, version, get_status, checksum, message, mocked_requests, cli):
+    """Calling self_update() when any check or request to DebMonitor fails should raise RuntimeError."""
+    headers = {}
+    if version is not None:
+        headers[cli.CLIENT_VERSION_HEADER] = version
+    mocked_requests.register_uri('HEAD', DEBMONITOR_CLIENT_URL, status_code=head_status, headers=headers)
+
+    if get_status is not None:
+        get_headers = dict(headers)
+        if checksum is not None:
+            get_headers[cli.CLIENT_CHECKSUM_HEADER] = checksum
+        mocked_requests.register_uri('GET', DEBMONITOR_CLIENT_URL, status_code=get_status, text='data',
+                                     headers=get_headers)
+
+    with pytest.raises(RuntimeError, match=message):
         cli.self_update(DEBMONITOR_BASE_URL, None)
 
     assert mocked_requests.called
 
 
-def test_self_update_has_update_wrong_hash(mocked_requests):
-    """Calling self_update() when the checksum mismatch should raise RuntimeError."""
+def test_self_update_head_same_version(mocked_requests, cli):
+    """Calling self_update() when client on DebMonitor is at the same version should return without doing anything."""
     mocked_requests.register_uri(
-        'HEAD', DEBMONITOR_CLIENT_URL, status_code=200, headers={cli.CLIENT_VERSION_HEADER: DEBMONITOR_CLIENT_VERSION})
-    mocked_requests.register_uri('GET', DEBMONITOR_CLIENT_URL, status_code=200, text='data',
-                                 headers={cli.CLIENT_VERSION_HEADER: DEBMONITOR_CLIENT_VERSION,
-                                          cli.CLIENT_CHECKSUM_HEADER: '000000'})
+        'HEAD', DEBMONITOR_CLIENT_URL, status_code=200, headers={cli.CLIENT_VERSION_HEADER: cli.__version__})
 
-    with pytest.raises(RuntimeError, match='The checksum of the script do not match the HTTP header'):
-        cli.self_update(DEBMONITOR_BASE_URL, None)
+    ret = cli.self_update(DEBMONITOR_BASE_URL, None)
 
+    assert ret is None
     assert mocked_requests.called
 
 
-def test_self_update_has_update_ok(mocked_requests):
+def test_self_update_has_update_ok(mocked_requests, cli):
     """Calling self_update() should self-update the CLI script."""
     mocked_requests.register_uri(
         'HEAD', DEBMONITOR_CLIENT_URL, status_code=200, headers={cli.CLIENT_VERSION_HEADER: DEBMONITOR_CLIENT_VERSION})
@@ -364,37 +825,51 @@ def test_self_update_has_update_ok(mocked_requests):
             cli.CLIENT_VERSION_HEADER: DEBMONITOR_CLIENT_VERSION,
             cli.CLIENT_CHECKSUM_HEADER: DEBMONITOR_CLIENT_CHECKSUM})
 
-    with patch('builtins.open', mock_open()) as mocked_open:
+    fake_file = FakeFile(os.path.realpath(cli.__file__))
+    with patch('builtins.open', fake_file):
         cli.self_update(DEBMONITOR_BASE_URL, None)
 
-        mocked_open.assert_called_once_with(os.path.realpath(cli.__file__), mode='w')
-        mocked_handler = mocked_open()
-        mocked_handler.write.assert_called_once_with('data')
+    assert fake_file.opened == [((os.path.realpath(cli.__file__),), {'mode': 'w'})]
+    assert fake_file.written == ['data']
 
     assert mocked_requests.called
 
 
 @pytest.mark.parametrize('params', ([], ['-u'], ['-k', 'cert.key', '-c', 'cert.pem'], ['-c', 'cert.pem']))
 @patch('socket.getfqdn', return_value=HOSTNAME)
-def test_main(mocked_getfqdn, params, mocked_requests):
+def test_main(mocked_getfqdn, params, parsed_args, preregistered_requests, apt_caches, cli):
     """Calling main() should send the updates to the DebMonitor server with the above parameters."""
-    args = cli.parse_args(['-s', DEBMONITOR_SERVER] + params)
-    mocked_requests.register_uri('POST', DEBMONITOR_UPDATE_URL, status_code=201)
-    _reset_apt_caches()
+    exit_code = cli.main(parsed_args)
+
+    mocked_getfqdn.assert_called_once_with()
+    assert preregistered_requests.called
+    assert exit_code == 0
+    assert 'Content-Encoding' not in preregistered_requests.last_request.headers
+    assert preregistered_requests.last_request.json() == _get_payload_with_packages(tuple(params))
+    if '-u' in params:
+        assert preregistered_requests.last_request.timeout == (5, 300)
+    else:  # Full update, no read timeout
+        assert preregistered_requests.last_request.timeout == (5, None)
+
+
+@patch('socket.getfqdn', return_value=HOSTNAME)
+def test_main_compressed(mocked_getfqdn, monkeypatch, preregistered_requests, apt_caches, cli):
+    """Calling main() with a payload bigger than the threshold should send it compressed with gzip."""
+    monkeypatch.setattr(cli, 'COMPRESS_MIN_SIZE', 10)
+    args = cli.parse_args(['-s', DEBMONITOR_SERVER])
 
     exit_code = cli.main(args)
 
-    mocked_getfqdn.assert_called_once_with()
-    assert mocked_requests.called
     assert exit_code == 0
-    assert mocked_requests.last_request.json() == _get_payload_with_packages(params)
+    assert preregistered_requests.last_request.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(preregistered_requests.last_request.body).decode('utf-8')) == \
+        EXPECTED_PAYLOAD_FULL
 
 
 @patch('socket.getfqdn', return_value=HOSTNAME)
-def test_main_no_packages(mocked_getfqdn):
+def test_main_no_packages(mocked_getfqdn, empty_apt_caches, cli):
     """Calling main() if there are no updates should success without sending any update to the DebMonitor server."""
     args = cli.parse_args(['-s', DEBMONITOR_SERVER])
-    _reset_apt_caches(empty=True)
 
     exit_code = cli.main(args)
 
@@ -403,42 +878,38 @@ def test_main_no_packages(mocked_getfqdn):
 
 
 @patch('socket.getfqdn', return_value=HOSTNAME)
-def test_main_dry_run(mocked_getfqdn, capsys):
+def test_main_dry_run(mocked_getfqdn, capsys, apt_caches, cli):
     """Calling main() with dry-run parameter should print the updates without sending them to the DebMonitor server."""
     args = cli.parse_args(['-s', DEBMONITOR_SERVER, '-n'])
-    _reset_apt_caches()
 
     exit_code = cli.main(args)
 
     out, _ = capsys.readouterr()
     mocked_getfqdn.assert_called_once_with()
     assert exit_code == 0
-    assert json.loads(out) == _get_payload_with_packages([])
+    assert json.loads(out) == EXPECTED_PAYLOAD_FULL
 
 
 @pytest.mark.parametrize('params', ([], ['-d']))
 @patch('socket.getfqdn', return_value=HOSTNAME)
-def test_main_wrong_http_code(mocked_getfqdn, params, mocked_requests, caplog):
+def test_main_wrong_http_code(mocked_getfqdn, params, parsed_args, preregistered_requests, caplog, apt_caches, cli):
     """Calling main() when the DebMonitor server returns a wrong HTTP code should return 1."""
-    args = cli.parse_args(['-s', DEBMONITOR_SERVER] + params)
-    mocked_requests.register_uri('POST', DEBMONITOR_UPDATE_URL, status_code=400)
-    _reset_apt_caches()
+    preregistered_requests.register_uri('POST', DEBMONITOR_UPDATE_URL, status_code=400)
 
-    exit_code = cli.main(args)
+    exit_code = cli.main(parsed_args)
 
     mocked_getfqdn.assert_called_once_with()
-    assert mocked_requests.called
+    assert preregistered_requests.called
     assert exit_code == 1
-    assert mocked_requests.last_request.json() == _get_payload_with_packages(params)
+    assert preregistered_requests.last_request.json() == _get_payload_with_packages(tuple(params))
     assert 'Failed to send the update to the DebMonitor server' in caplog.text
 
 
 @patch('socket.getfqdn', return_value=HOSTNAME)
-def test_main_dpkg_hook(mocked_getfqdn, mocked_requests):
+def test_main_dpkg_hook(mocked_getfqdn, preregistered_requests, mocked_apt, cli):
     """Calling main() with -g should parse the input for a Dpkg::Pre-Install-Pkgs hook and send the update."""
     args = cli.parse_args(['-s', DEBMONITOR_SERVER, '-g'])
-    input_lines = _get_dpkg_hook_preamble(3) + APT_HOOK_LINES[3][0:2]
-    mocked_requests.register_uri('POST', DEBMONITOR_UPDATE_URL, status_code=201)
+    input_lines = io.StringIO(''.join(DPKG_HOOK_PREAMBLE[3] + APT_HOOK_LINES[3][0:2]))  # Like stdin
     mocked_apt.cache.Cache().__getitem__.return_value = AptPackage(
         name='package-name', is_installed=False, installed=None,
         candidate=AptPkgVersion(source_name='package-name', version='1.0.0-1'))
@@ -446,66 +917,81 @@ def test_main_dpkg_hook(mocked_getfqdn, mocked_requests):
     exit_code = cli.main(args, input_lines=input_lines)
 
     mocked_getfqdn.assert_called_once_with()
-    assert mocked_requests.called
+    assert preregistered_requests.called
     assert exit_code == 0
-    assert mocked_requests.last_request.json() == _get_payload_with_packages(['-g'])
+    assert preregistered_requests.last_request.json() == _get_payload_with_packages(('-g',))
 
 
 @patch('socket.getfqdn', return_value=HOSTNAME)
-def test_main_update_fail(mocked_getfqdn, mocked_requests, caplog):
+def test_main_dpkg_hook_no_changes(mocked_getfqdn, preregistered_requests, cli):
+    """Calling main() with -g and only packages to configure should success without sending any update."""
+    args = cli.parse_args(['-s', DEBMONITOR_SERVER, '-g'])
+    input_lines = io.StringIO(''.join(DPKG_HOOK_PREAMBLE[3] + APT_HOOK_LINES[3][1:2]))  # Like stdin
+
+    exit_code = cli.main(args, input_lines=input_lines)
+
+    assert exit_code == 0
+    assert not preregistered_requests.called
+
+
+@patch('socket.getfqdn', return_value=HOSTNAME)
+def test_main_update_fail(mocked_getfqdn, preregistered_requests, caplog, apt_caches, cli):
     """Calling main() whit --update that fails the update should log the error and continue."""
     args = cli.parse_args(['-s', DEBMONITOR_SERVER, '--update'])
-    mocked_requests.register_uri('POST', DEBMONITOR_UPDATE_URL, status_code=201)
-    mocked_requests.register_uri('HEAD', DEBMONITOR_CLIENT_URL, status_code=500)
-    _reset_apt_caches()
+    preregistered_requests.register_uri('HEAD', DEBMONITOR_CLIENT_URL, status_code=500)
 
     exit_code = cli.main(args)
 
-    assert mocked_requests.called
+    assert preregistered_requests.called
     mocked_getfqdn.assert_called_once_with()
     assert exit_code == 0
     assert 'Unable to self-update this script' in caplog.text
 
 
 @patch('socket.getfqdn', return_value=HOSTNAME)
-def test_main_update_ok(mocked_getfqdn, mocked_requests, caplog):
+def test_main_update_ok(mocked_getfqdn, preregistered_requests, caplog, apt_caches, cli):
     """Calling main() whit --update that succeed should update the CLI script."""
     args = cli.parse_args(['-s', DEBMONITOR_SERVER, '--update'])
-    mocked_requests.register_uri('POST', DEBMONITOR_UPDATE_URL, status_code=201)
-    mocked_requests.register_uri(
+    preregistered_requests.register_uri(
         'HEAD', DEBMONITOR_CLIENT_URL, status_code=200, headers={cli.CLIENT_VERSION_HEADER: DEBMONITOR_CLIENT_VERSION})
-    mocked_requests.register_uri(
+    preregistered_requests.register_uri(
         'GET', DEBMONITOR_CLIENT_URL, status_code=200, text='data', headers={
             cli.CLIENT_VERSION_HEADER: DEBMONITOR_CLIENT_VERSION,
             cli.CLIENT_CHECKSUM_HEADER: DEBMONITOR_CLIENT_CHECKSUM})
-    _reset_apt_caches()
 
-    with patch('builtins.open', mock_open()) as mocked_open:
+    fake_file = FakeFile(os.path.realpath(cli.__file__))
+    with patch('builtins.open', fake_file):
         exit_code = cli.main(args)
 
-        mocked_open.assert_called_once_with(os.path.realpath(cli.__file__), mode='w')
-        mocked_handler = mocked_open()
-        mocked_handler.write.assert_called_once_with('data')
+    assert fake_file.opened == [((os.path.realpath(cli.__file__),), {'mode': 'w'})]
+    assert fake_file.written == ['data']
 
-    assert mocked_requests.called
+    assert preregistered_requests.called
     mocked_getfqdn.assert_called_once_with()
     assert exit_code == 0
     assert 'Successfully self-updated DebMonitor CLI' in caplog.text
 
 
+@functools.lru_cache(maxsize=None)
+def _parse_args(cli, params):
+    """Parse only once the CLI arguments for the DebMonitor server and the given parameters as a tuple."""
+    return cli.parse_args(['-s', DEBMONITOR_SERVER] + list(params))
+
+
+@functools.lru_cache(maxsize=None)
 def _get_payload_with_packages(params):
-    """Given the current CLI parameters return the expected payload to be sent by DebMonitor."""
-    if params == ['-u']:
+    """Given the current CLI parameters as a tuple return the expected payload to be sent by DebMonitor."""
+    if params == ('-u',):
         installed = []
-        upgradable = CLI_UPGRADES
+        upgradable = list(CLI_UPGRADES)
         upgrade_type = 'partial'
-    elif params == ['-g']:
+    elif params == ('-g',):
         installed = [{'name': 'package-name', 'version': '1.0.0-1', 'source': 'package-name'}]
         upgradable = []
         upgrade_type = 'partial'
     else:
-        installed = CLI_PACKAGES
-        upgradable = CLI_UPGRADES
+        installed = list(CLI_PACKAGES)
+        upgradable = list(CLI_UPGRADES)
         upgrade_type = 'full'
 
     payload = {
@@ -525,26 +1011,4 @@ def _get_payload_with_packages(params):
     return payload
 
 
-def _reset_apt_caches(empty=False):
-    """Reset the mocked apt caches with the pre-defined packages or none if empty is True."""
-    if empty:
-        installed = []
-        upgrades = []
-    else:
-        installed = APT_PACKAGES
-        upgrades = APT_UPGRADES
-
-    mocked_apt.cache.FilteredCache().__iter__.return_value = installed
-    mocked_apt.cache.FilteredCache().__len__.return_value = len(installed)
-    mocked_apt.cache.FilteredCache().get_changes.return_value = upgrades
-
-
-def _get_dpkg_hook_preamble(version):
-    return [
-        'VERSION {version}\n'.format(version=version),
-        'APT::Architecture=amd64\n',
-        'APT::Build-Essential::=build-essential\n',
-        'APT::Install-Recommends=0\n',
-        'APT::Install-Suggests=0\n',
-        '\n',
-    ]
+EXPECTED_PAYLOAD_FULL = types.MappingProxyType(_get_payload_with_packages(()))
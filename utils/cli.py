@@ -30,7 +30,7 @@ This script was tested with Python 2.7, 3.5, 3.6.
 
   * python-apt
   * python-requests
-  * lsb-release
+  * python3-orjson (optional, Python3 only): if available it's used to serialize the report faster
 
 * Deploy this standalone CLI script across the fleet, for example into ``/usr/local/bin/debmonitor``, and make it
   executable, optionally modifying the shebang to force a specific Python version. The script can also be downloaded
@@ -52,34 +52,56 @@ This script was tested with Python 2.7, 3.5, 3.6.
   It is also required to run DebMonitor in full mode at least once to track all the packages. Optionally set the
   --update option so that the script will automatically check for available updates and will overwrite itself with the
   latest version available on the DebMonitor server.
+* The FQDN of the host is resolved once per boot and cached in ``/run/debmonitor.fqdn``, to avoid slow DNS queries at
+  each run. Delete that file to force a new resolution without rebooting, for example after renaming the host.
 
 """
 from __future__ import print_function
 
 import argparse
+import glob
 import hashlib
 import json
 import logging
 import os
-import platform
+import re
 import socket
 import sys
-
-from collections import namedtuple
+import tempfile
+import zlib
 
 import apt
-import lsb_release
 import requests
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 __version__ = '1.1.0'
 
 CLIENT_VERSION_HEADER = 'X-Debmonitor-Client-Version'
 CLIENT_CHECKSUM_HEADER = 'X-Debmonitor-Client-Checksum'
 logger = logging.getLogger('debmonitor')
-AptLineV2 = namedtuple('LineV2', ['name', 'version_from', 'direction', 'version_to', 'action'])
-AptLineV3 = namedtuple('LineV3', ['name', 'version_from', 'arch_from', 'multiarch_from', 'direction', 'version_to',
-                                  'arch_to', 'multiarch_to', 'action'])
+PACKAGES_CACHE_DIR = '/var/cache/debmonitor'  # Set to None to disable the caching of the collected packages
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+APT_LISTS_PATTERN = '/var/lib/apt/lists/*_Packages*'  # Also the compressed ones, see Acquire::GzipIndexes
+APT_PREFERENCES_PATTERNS = ('/etc/apt/preferences', '/etc/apt/preferences.d/*')  # The pinning affects the candidates
+OS_RELEASE_PATH = '/etc/os-release'
+HOSTNAME_CACHE_PATH = '/run/debmonitor.fqdn'  # On a tmpfs, to resolve the FQDN again after a reboot. None to disable it
+COMPRESS_MIN_SIZE = 1024  # Compress the payloads bigger than this number of bytes before sending them
+HTTP_TIMEOUT = (5, 30)  # Connect and read timeouts in seconds for the requests to the DebMonitor server
+# Connect and read timeouts in seconds for sending the updates, by update type. The server processes them synchronously
+# and a full update of a new host with thousands of packages might take a long time, hence without a read timeout.
+UPDATE_TIMEOUTS = {'full': (5, None), 'partial': (5, 300)}
+_session = None  # Shared requests session, see get_session()
+# Compiled regular expressions to parse a Dpkg::Pre-Install-Pkgs hook line, by protocol version. The matched groups are
+# always: name, version_from, direction, version_to.
+APT_LINE_PATTERNS = {
+    2: re.compile(r'(\S+) (\S+) ([<>=]) (\S+) \S+\s*$'),
+    3: re.compile(r'(\S+) (\S+) \S+ \S+ ([<>=]) (\S+) \S+ \S+ \S+\s*$'),
+}
 
 
 class AptInstalledFilter(apt.cache.Filter):
@@ -100,79 +122,244 @@ class AptInstalledFilter(apt.cache.Filter):
         return False
 
 
+class StringsPool(dict):
+    """Pool of strings to share a single object among equal strings, looking them up as keys: pool[string]."""
+
+    def __missing__(self, key):
+        """Add the string to the pool the first time it's seen.
+
+        :Parameters:
+            according to parent `__missing__` method.
+
+        Returns:
+            str: the given string.
+        """
+        self[key] = key
+        return key
+
+
 def get_packages(upgradable_only=False):
     """Return the list of installed and upgradable packages, or only the upgradable ones.
 
+    The result is cached on disk and reused until the dpkg status or the APT lists are modified.
+
+    Arguments:
+        upgradable_only (bool, optional): whether to return only the upgradable packages.
+
+    Returns:
+        dict: a dictionary of lists with the installed and upgradable packages.
+    """
+    cache_path, state = get_packages_cache_key(upgradable_only)
+    if cache_path is not None:
+        packages = read_packages_cache(cache_path, state)
+        if packages is not None:
+            logger.info('Loaded the packages from %s, dpkg and APT state unchanged', cache_path)
+            return packages
+
+    packages = collect_packages(upgradable_only=upgradable_only)
+
+    if cache_path is not None:
+        write_packages_cache(cache_path, state, packages)
+
+    return packages
+
+
+def collect_packages(upgradable_only=False):
+    """Collect from the apt cache the list of installed and upgradable packages, or only the upgradable ones.
+
     Arguments:
         upgradable_only (bool, optional): whether to return only the upgradable packages.
 
     Returns:
         dict: a dictionary of lists with the installed and upgradable packages.
     """
-    packages = {'installed': [], 'upgradable': [], 'uninstalled': []}
     cache = apt.cache.FilteredCache()
     cache.set_filter(AptInstalledFilter())
     logger.info('Found %d installed binary packages', len(cache))
 
-    cache.upgrade(dist_upgrade=True)
-    upgrades = cache.get_changes()
+    if any(pkg.is_upgradable for pkg in cache):
+        cache.upgrade(dist_upgrade=True)
+        upgrades = cache.get_changes()
+    else:  # Skip the APT resolver, the slowest step, when there is nothing to upgrade
+        upgrades = []
     logger.info('Found %d upgradable binary packages (including new dependencies)', len(upgrades))
 
-    if not upgradable_only:
-        for pkg in cache:
-            package = {'name': pkg.name, 'version': pkg.installed.version, 'source': pkg.installed.source_name}
-            packages['installed'].append(package)
+    sources = StringsPool()  # Many binary packages share the same source package, keep a single copy of its name
+    if upgradable_only:
+        installed = []
+    else:
+        installed = [{'name': pkg.name, 'version': pkg.installed.version, 'source': sources[pkg.installed.source_name]}
+                     for pkg in cache]
+
+    # Not fused with the loop above: the changes are a small subset of the installed packages, so a separate loop over
+    # them costs less than a by-name lookup for each installed package. They include also the new dependencies, that
+    # are not installed yet.
+    upgradable = [{'name': pkg.name, 'version_from': pkg.installed.version, 'version_to': pkg.candidate.version,
+                   'source': sources[pkg.candidate.source_name]} for pkg in upgrades if pkg.is_installed]
+
+    if logger.isEnabledFor(logging.DEBUG):  # Avoid looping over thousands of packages when not needed
+        for package in installed:
             logger.debug('Collected installed: %s', package)
+        for upgrade in upgradable:
+            logger.debug('Collected upgrade: %s', upgrade)
 
-    for pkg in upgrades:
-        if not pkg.is_installed:
-            continue
+    return {'installed': installed, 'upgradable': upgradable, 'uninstalled': []}
 
-        upgrade = {'name': pkg.name, 'version_from': pkg.installed.version, 'version_to': pkg.candidate.version,
-                   'source': pkg.candidate.source_name}
-        packages['upgradable'].append(upgrade)
-        logger.debug('Collected upgrade: %s', upgrade)
 
-    return packages
+def get_packages_cache_key(upgradable_only):
+    """Return the path of the packages cache file and the current state of dpkg, of the APT lists and preferences.
+
+    Arguments:
+        upgradable_only (bool): whether the cache is for only the upgradable packages.
+
+    Returns:
+        tuple: a tuple (str, str) with the path of the cache file and the checksum of the modification times of the
+            dpkg status file, of the APT lists directory and files and of the APT preferences files. It's (None, None)
+            if the cache is disabled or the state can't be determined.
+
+    """
+    if PACKAGES_CACHE_DIR is None:
+        return None, None
+
+    try:
+        # The directory changes whenever APT adds, replaces or removes a list, whatever its name
+        paths = [DPKG_STATUS_PATH, os.path.dirname(APT_LISTS_PATTERN)] + sorted(glob.glob(APT_LISTS_PATTERN))
+        for pattern in APT_PREFERENCES_PATTERNS:
+            paths += sorted(glob.glob(pattern))
+        mtimes = [(path, os.stat(path).st_mtime) for path in paths]
+    except EnvironmentError as e:
+        logger.debug('Unable to determine the state of dpkg and APT lists, not using the packages cache: %s', e)
+        return None, None
+
+    state = hashlib.md5(repr((__version__, mtimes)).encode('utf-8')).hexdigest()
+    name = 'packages-upgradable.json' if upgradable_only else 'packages-full.json'
+
+    return os.path.join(PACKAGES_CACHE_DIR, name), state
+
+
+def read_packages_cache(path, state):
+    """Return the cached packages if they were collected with the given state of dpkg and of the APT lists.
+
+    Arguments:
+        path (str): the path of the cache file.
+        state (str): the current state of dpkg and of the APT lists, as returned by `get_packages_cache_key()`.
+
+    Returns:
+        dict: the cached dictionary of lists with the installed and upgradable packages or None if missing or stale.
+
+    """
+    try:
+        with open(path, 'r') as cache_file:
+            cached = json.load(cache_file)
+    except (EnvironmentError, ValueError) as e:
+        logger.debug('Unable to read the packages cache %s: %s', path, e)
+        return None
+
+    if cached.get('state') != state:
+        return None
+
+    return cached.get('packages')
+
+
+def write_packages_cache(path, state, packages):
+    """Atomically write the packages cache file, logging any error.
+
+    Arguments:
+        path (str): the path of the cache file.
+        state (str): the current state of dpkg and of the APT lists, as returned by `get_packages_cache_key()`.
+        packages (dict): the dictionary of lists with the installed and upgradable packages to cache.
+
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        write_file_atomically(path, json.dumps({'state': state, 'packages': packages}))
+    except EnvironmentError as e:
+        logger.debug('Unable to write the packages cache %s: %s', path, e)
+
+
+def write_file_atomically(path, content):
+    """Write the content to a uniquely named temporary file in the same directory and then rename it to path.
+
+    Concurrent runs, like the cron and an APT hook, can safely write the same file.
+
+    Arguments:
+        path (str): the path of the file to write.
+        content (str): the content to write.
+
+    Raises:
+        EnvironmentError: on failure, the temporary file is removed.
+
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{name}.'.format(name=os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(content)
+
+        os.rename(tmp_path, path)
+    except EnvironmentError:
+        os.unlink(tmp_path)
+        raise
 
 
 def parse_dpkg_hook(input_lines):
     """Parse packages changes as reported by the Dpkg::Pre-Install-Pkgs hook.
 
     Arguments:
-        input_lines (list): list of strings with the Dpkg::Pre-Install-Pkgs hook output.
+        input_lines (iterable): iterable of strings with the Dpkg::Pre-Install-Pkgs hook output, like a list of lines
+            or a file object. It's consumed line by line and only the lines with a package change are kept.
 
     Returns:
         dict: a dictionary of lists with the installed and uninstalled packages.
 
     Raises:
         RuntimeError: if the version of the Dpkg::Pre-Install-Pkgs hook protocol is not supported or unable to
-            determine its version.
+            determine its version, or if any package line is not in the expected format.
 
     """
-    hook_version_line = input_lines.pop(0).strip()
+    lines = iter(input_lines)
+    hook_version_line = next(lines, '')
 
     if not hook_version_line.startswith('VERSION '):
-        raise RuntimeError('Expected VERSION line to be the first one, got: {ver}'.format(ver=hook_version_line))
+        raise RuntimeError('Expected VERSION line to be the first one, got: {ver}'.format(
+            ver=hook_version_line.strip()))
 
-    hook_version = int(hook_version_line[-1])
-    if hook_version not in (2, 3):
-        raise RuntimeError('Unsupported version {ver}'.format(ver=hook_version))
+    version = hook_version_line[8:].strip()  # Only the short version token after the prefix needs to be stripped
+    if version not in ('2', '3'):
+        raise RuntimeError('Unsupported version {ver}'.format(ver=version))
 
-    try:
-        upgrades = input_lines[input_lines.index('\n') + 1:]
-    except ValueError:
+    hook_version = int(version)
+
+    for line in lines:  # Skip the APT configuration preamble
+        if line == '\n':
+            break
+    else:
         raise RuntimeError('Unable to find the empty line separator in input')
 
-    if not upgrades:
+    # Keep only the lines with a package change, the source names are looked up all at once before parsing them
+    match_line = APT_LINE_PATTERNS[hook_version].match
+    changes = []
+    names = set()
+    add_change = changes.append  # Bind the methods once, this loop runs for each line of the transaction
+    add_name = names.add
+    for update_line in lines:
+        change = match_apt_change(update_line, match_line)  # Malformed lines are reported before the apt cache lookup
+        if change is None:
+            continue
+
+        add_change(change)  # Keep the matched groups, to not match the line again
+        add_name(change[0])
+
+    if not changes:  # Only packages to configure or re-install, avoid to load the apt cache
         return {}
 
+    sources = get_source_names(apt.cache.Cache(), names)
+
     packages = {'installed': [], 'upgradable': [], 'uninstalled': []}
-    cache = apt.cache.Cache()
-    for update_line in upgrades:
-        group, package = parse_apt_line(update_line, cache, version=hook_version)
-        if group is not None:
-            packages[group].append(package)
+    for change in changes:
+        group, package = parse_apt_change(change, sources)
+        packages[group].append(package)
 
     logger.info('Got %d updates from dpkg hook version %d', len(packages['installed']) + len(packages['uninstalled']),
                 hook_version)
@@ -180,7 +367,75 @@ def parse_dpkg_hook(input_lines):
     return packages
 
 
-def parse_apt_line(update_line, cache, version=3):
+def get_source_names(cache, names):
+    """Return the source package names of the candidate and installed versions of the given binary packages.
+
+    Arguments:
+        cache (apt.cache.Cache): a `apt.cache.Cache` instance to gather the metadata of the packages.
+        names (set): the names of the binary packages to look up, each one is looked up only once.
+
+    Returns:
+        dict: a dictionary with the binary package names as keys and a tuple (str, str) as values with the source
+            package name of the candidate and of the installed version. Each of them is None if there is no such
+            version.
+
+    """
+    sources = {}
+    for name in names:
+        cache_item = cache[name]
+        candidate = cache_item.candidate
+        installed = cache_item.installed
+        sources[name] = (candidate.source_name if candidate is not None else None,
+                         installed.source_name if installed is not None else None)
+
+    return sources
+
+
+def is_configure_line(update_line):
+    """Check if a Dpkg::Pre-Install-Pkgs hook line is about configuring a package, with a fast path for the common case.
+
+    Arguments:
+        update_line (str): one line of the Dpkg::Pre-Install-Pkgs hook output.
+
+    Returns:
+        bool: True if the line is a configure one, False otherwise.
+
+    """
+    # The lines usually end with just a newline, strip them only in the unusual case of other trailing whitespaces
+    return update_line.endswith('**CONFIGURE**\n') or update_line.rstrip().endswith('**CONFIGURE**')
+
+
+def match_apt_change(update_line, match_line):
+    """Match a single Dpkg::Pre-Install-Pkgs hook line, skipping the lines without a package change.
+
+    Arguments:
+        update_line (str): one line of the Dpkg::Pre-Install-Pkgs hook output.
+        match_line (callable): the bound match() method of the `APT_LINE_PATTERNS` regular expression for the hook
+            protocol version.
+
+    Returns:
+        tuple: a tuple (str, str, str, str) with the package name, the version from, the direction of the change and
+            the version to. None for the lines to configure or re-install a package, that don't change it.
+
+    Raises:
+        RuntimeError: if the line is not in the expected format.
+
+    """
+    if is_configure_line(update_line):  # Skip those lines, package already tracked
+        return None
+
+    match = match_line(update_line)
+    if match is None:
+        raise RuntimeError('Unable to parse line: {line}'.format(line=update_line.strip()))
+
+    change = match.groups()
+    if change[2] == '=':  # Re-installation, no change
+        return None
+
+    return change
+
+
+def parse_apt_line(update_line, sources, version=3):
     """Parse a single package line as reported by the Dpkg::Pre-Install-Pkgs hook version 3 or 2.
 
     - Protocol version 2 examples
@@ -225,7 +480,7 @@ def parse_apt_line(update_line, cache, version=3):
 
     Arguments:
         update_line (str): one line of the Dpkg::Pre-Install-Pkgs hook output.
-        cache (apt.cache.Cache): a `apt.cache.Cache` instance to gather additional metadata of the modified packages.
+        sources (dict): the source package names of the modified packages, as returned by `get_source_names()`.
         version (int, optional): the Dpkg::Pre-Install-Pkgs hook protocol version. Supported versions are: 2, 3.
 
     Returns:
@@ -233,47 +488,167 @@ def parse_apt_line(update_line, cache, version=3):
             package metadata. The group is one of 'installed', 'uninstalled'.
 
     Raises:
-        RuntimeError: if the version of the Dpkg::Pre-Install-Pkgs hook protocol is not supported.
+        RuntimeError: if the version of the Dpkg::Pre-Install-Pkgs hook protocol is not supported or the line is not
+            in the expected format.
 
     """
-    if version == 3:
-        line = AptLineV3(*update_line.strip().split(' ', 9))
-    elif version == 2:
-        line = AptLineV2(*update_line.strip().split(' ', 5))
-    else:
+    try:
+        pattern = APT_LINE_PATTERNS[version]
+    except KeyError:
         raise RuntimeError('Unsupported version {ver}'.format(ver=version))
 
-    if line.action in ('**CONFIGURE**'):  # Skip those lines, package already tracked
+    change = match_apt_change(update_line, pattern.match)
+    if change is None:
         return None, None
 
-    cache_item = cache[line.name]
-    if line.direction == '<':  # Upgrade
+    return parse_apt_change(change, sources)
+
+
+def parse_apt_change(change, sources):
+    """Parse a single package change already matched from a Dpkg::Pre-Install-Pkgs hook line.
+
+    Arguments:
+        change (tuple): the groups matched by one of the `APT_LINE_PATTERNS` regular expressions, a tuple (str, str,
+            str, str) with the package name, the version from, the direction of the change and the version to.
+            The direction must be one of '<', '>'.
+        sources (dict): the source package names of the modified packages, as returned by `get_source_names()`.
+
+    Returns:
+        tuple: a tuple (str, dict) with the name of the group the package belongs to and the dictionary with the
+            package metadata. The group is one of 'installed', 'uninstalled'.
+
+    """
+    name, version_from, direction, version_to = change
+    candidate_source, installed_source = sources[name]
+    if direction == '<':  # Upgrade
         group = 'installed'
-        package = {'name': line.name, 'version': line.version_to, 'source': cache_item.candidate.source_name}
+        package = {'name': name, 'version': version_to, 'source': candidate_source}
 
-        if line.version_from == '-':
+        if version_from == '-':
             action = 'installed'
         else:
             action = 'upgraded'
-        logger.debug('Collected %s package: %s', action, package)
 
-    elif line.direction == '>':  # Downgrade/removal
-        if line.version_to == '-':  # Removal
-            group = 'uninstalled'
-            package = {'name': line.name, 'version': line.version_from, 'source': cache_item.installed.source_name}
-            logger.debug('Collected removed package: %s', package)
-        else:  # Downgrade
-            group = 'installed'
-            package = {'name': line.name, 'version': line.version_to, 'source': cache_item.candidate.source_name}
-            logger.debug('Collected downgraded package: %s', package)
+    elif version_to == '-':  # Removal (>)
+        group = 'uninstalled'
+        package = {'name': name, 'version': version_from, 'source': installed_source}
+        action = 'removed'
+
+    else:  # Downgrade (>)
+        group = 'installed'
+        package = {'name': name, 'version': version_to, 'source': candidate_source}
+        action = 'downgraded'
 
-    else:  # No change (=)
-        group = None
-        package = None
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Collected %s package: %s', action, package)
 
     return group, package
 
 
+def get_hostname():
+    """Return the FQDN of the host, resolving it only if not already cached since the last boot.
+
+    The resolution of the FQDN might perform DNS queries that block for a long time if the DNS is not responsive.
+    If the resolution fails, socket.getfqdn() falls back to the hostname, that might be the short one, hence the FQDN
+    is cached only when it's qualified and different from the hostname, to not reuse a wrong name until the reboot.
+
+    Returns:
+        str: the FQDN of the host.
+
+    """
+    if HOSTNAME_CACHE_PATH is None:
+        return socket.getfqdn()
+
+    try:
+        with open(HOSTNAME_CACHE_PATH, 'r') as cache_file:
+            hostname = cache_file.read().strip()
+    except EnvironmentError as e:
+        logger.debug('Unable to read the hostname cache %s: %s', HOSTNAME_CACHE_PATH, e)
+        hostname = ''
+
+    if hostname:
+        return hostname
+
+    hostname = socket.getfqdn()
+    if '.' not in hostname or hostname == socket.gethostname():
+        logger.debug('Not caching the hostname %s, it might be the fallback of a failed FQDN resolution', hostname)
+        return hostname
+
+    try:
+        write_file_atomically(HOSTNAME_CACHE_PATH, hostname)
+    except EnvironmentError as e:
+        logger.debug('Unable to write the hostname cache %s: %s', HOSTNAME_CACHE_PATH, e)
+
+    return hostname
+
+
+def get_os_name():
+    """Return the name of the operating system, as reported by the ID field of the os-release file.
+
+    The file is parsed directly to avoid the external processes that the lsb_release module might spawn.
+
+    Returns:
+        str: the capitalized ID of the operating system, like 'Debian', or 'unknown' if unable to find it.
+
+    """
+    try:
+        with open(OS_RELEASE_PATH, 'r') as os_release:
+            for line in os_release:
+                key, _, value = line.strip().partition('=')
+                if key == 'ID':
+                    return value.strip('"\'').title()
+    except EnvironmentError as e:
+        logger.debug('Unable to read %s: %s', OS_RELEASE_PATH, e)
+
+    return 'unknown'
+
+
+def serialize_payload(payload):
+    """Serialize the payload to JSON, with the orjson C library if available or the json module otherwise.
+
+    Arguments:
+        payload (dict): the payload to serialize.
+
+    Returns:
+        bytes: the JSON-encoded payload.
+
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+
+    return json.dumps(payload).encode('utf-8')
+
+
+def compress_payload(body):
+    """Compress the serialized payload with gzip, with the fastest level as the payload is highly repetitive.
+
+    The zlib module is used directly because gzip.compress() is not available in Python 2.
+
+    Arguments:
+        body (bytes): the serialized payload.
+
+    Returns:
+        bytes: the gzip-compressed payload.
+
+    """
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # Add the gzip header and trailer
+    return compressor.compress(body) + compressor.flush()
+
+
+def get_session():
+    """Return the shared requests session, to reuse the connection to the DebMonitor server across requests.
+
+    Returns:
+        requests.Session: the session, created at the first call.
+
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+
+    return _session
+
+
 def self_update(base_url, cert):
     """Check if the DebMonitor server has a different version of this script and automatically self-overwrite it.
 
@@ -287,7 +662,7 @@ def self_update(base_url, cert):
         RuntimeError: if no remote version is found or there is a checksum mismatch or a wrong HTTP status code.
     """
     client_url = '{base_url}/client'.format(base_url=base_url)
-    response = requests.head(client_url, cert=cert)
+    response = get_session().head(client_url, cert=cert, timeout=HTTP_TIMEOUT)
     if response.status_code != requests.status_codes.codes.ok:
         raise RuntimeError('Unable to check remote script version, got HTTP {retcode}, expected 200 OK.'.format(
             retcode=response.status_code))
@@ -302,7 +677,7 @@ def self_update(base_url, cert):
         return
 
     logger.info('Found new remote version %s, current version is %s. Updating.', version, __version__)
-    response = requests.get(client_url, cert=cert)
+    response = get_session().get(client_url, cert=cert, timeout=HTTP_TIMEOUT)
     if response.status_code != requests.status_codes.codes.ok:
         raise RuntimeError('Unable to download remote script, got HTTP {retcode}, expected 200 OK.'.format(
             retcode=response.status_code))
@@ -379,7 +754,7 @@ def run(args, input_lines=None):
         RuntimeError, requests.exceptions.RequestException: on error.
 
     """
-    hostname = socket.getfqdn()
+    hostname = get_hostname()
 
     if args.upgradable or args.dpkg_hook:
         upgrade_type = 'partial'
@@ -391,16 +766,17 @@ def run(args, input_lines=None):
     else:
         packages = get_packages(upgradable_only=args.upgradable)
 
-    if sum(len(i) for i in packages.values()) == 0:  # No packages to report
-        return
+    if not (packages.get('installed') or packages.get('uninstalled') or packages.get('upgradable')):
+        return  # No packages to report
 
+    uname = os.uname()  # A tuple in Python 2: (sysname, nodename, release, version, machine)
     payload = {
         'api_version': args.api,
-        'os': lsb_release.get_distro_information().get('ID', 'unknown'),
+        'os': get_os_name(),
         'hostname': hostname,
         'running_kernel': {
-            'release': platform.release(),
-            'version': platform.version(),
+            'release': uname[2],
+            'version': uname[3],
         },
         'installed': packages['installed'],
         'uninstalled': packages['uninstalled'],
@@ -421,7 +797,13 @@ def run(args, input_lines=None):
     elif args.cert is not None:
         cert = args.cert
 
-    response = requests.post(url, cert=cert, json=payload)
+    body = serialize_payload(payload)
+    headers = {'Content-Type': 'application/json'}
+    if len(body) > COMPRESS_MIN_SIZE:
+        body = compress_payload(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    response = get_session().post(url, cert=cert, data=body, headers=headers, timeout=UPDATE_TIMEOUTS[upgrade_type])
     if response.status_code != requests.status_codes.codes.created:
         raise RuntimeError('Failed to send the update to the DebMonitor server: {status} {body}'.format(
             status=response.status_code, body=response.text))
@@ -439,7 +821,7 @@ def main(args, input_lines=None):
 
     Arguments:
         args (argparse.Namespace): the parsed CLI parameters.
-        input_lines (list, optional): input lines from stdin when the -g/--dpkg-hook option is set.
+        input_lines (iterable, optional): input lines from stdin when the -g/--dpkg-hook option is set.
 
     Returns:
         int: the exit code of the operation. Zero on success, a positive integer on failure.
@@ -467,6 +849,6 @@ if __name__ == '__main__':  # pragma: no cover
     args = parse_args(sys.argv[1:])
     input_lines = None
     if args.dpkg_hook:
-        input_lines = sys.stdin.readlines()
+        input_lines = sys.stdin
 
     sys.exit(main(args, input_lines=input_lines))